@@ -4,27 +4,109 @@
 # - 源若 30 天无更新则跳过（STALE_DAYS）
 # - 生成 data/news.json 与 data/meta.json
 # - 不因单源失败导致脚本报错退出
+# - 以 ETag/Last-Modified 条件请求抓取，未修改（或正文摘要未变）的源沿用 data/feed_cache.json
 
 import os
+import re
 import json
+import asyncio
+import hashlib
+import heapq
+import calendar
+import aiohttp
 import feedparser
+from operator import itemgetter
+from collections import namedtuple
+from contextlib import contextmanager
+from urllib.parse import urlsplit, urlunsplit
 from datetime import datetime, timezone, timedelta
 
+try:
+    import orjson
+except ImportError:  # 未安装 orjson 时退回标准库 json
+    orjson = None
+
 # ---------- 可调参数（也可用环境变量覆盖） ----------
 STALE_DAYS = int(os.getenv("STALE_DAYS", "30"))
 PER_FEED_LIMIT = int(os.getenv("PER_FEED_LIMIT", "30"))
 TOTAL_LIMIT = int(os.getenv("TOTAL_LIMIT", "200"))
+CACHE_PATH = os.getenv("FEED_CACHE_PATH", "data/feed_cache.json")
 USER_AGENT = os.getenv("FEED_USER_AGENT", "Mozilla/5.0 (compatible; BESSNewsBot/1.2; +https://example.org)")
+FETCH_CONCURRENCY = int(os.getenv("FETCH_CONCURRENCY", "16"))
+FETCH_TIMEOUT = int(os.getenv("FETCH_TIMEOUT", "15"))
 # ---------------------------------------------------
 
-feedparser.USER_AGENT = USER_AGENT
+# 缓存快照的结构版本：条目的生成方式（字段、clean_summary 等）变化时递增；
+# 与 PER_FEED_LIMIT 一起写入缓存，不一致时整个缓存作废，避免 304 时沿用旧条目
+CACHE_SCHEMA = 2
+CACHE_VERSION = f"{CACHE_SCHEMA}:{PER_FEED_LIMIT}"
+
+# 摘要会在 clean_summary 中去掉全部标签，相对地址解析是多余开销；
+# HTML 清洗必须保留：标题（Atom type="html" 或形似 HTML 的 RSS 标题）同样依赖它，前端以 innerHTML 渲染
+feedparser.RESOLVE_RELATIVE_URIS = 0
+
+def json_loads(data: bytes):
+    return orjson.loads(data) if orjson else json.loads(data)
+
+def json_dumps(obj) -> bytes:
+    """2 空格缩进、保留非 ASCII 字符，输出与 json.dump(..., ensure_ascii=False, indent=2) 一致"""
+    if orjson:
+        return orjson.dumps(obj, option=orjson.OPT_INDENT_2 | orjson.OPT_NON_STR_KEYS)
+    return json.dumps(obj, ensure_ascii=False, indent=2).encode("utf-8")
+
+def dedup_feeds(feeds: list[str]) -> list[str]:
+    """去掉非 http(s) 的地址，并按 协议+域名+路径（忽略大小写与末尾 /）去重，保持原顺序"""
+    out, seen = [], set()
+    for u in feeds:
+        try:
+            p = urlsplit(u)
+        except ValueError:
+            continue
+        if p.scheme not in ("http", "https") or not p.netloc:
+            continue
+        k = (p.scheme, p.netloc.lower(), p.path.rstrip("/"), p.query)
+        if k in seen:
+            continue
+        seen.add(k)
+        out.append(u)
+    if len(out) < len(feeds):
+        print(f"⚠️ 已忽略 {len(feeds) - len(out)} 个无效或重复的源地址")
+    return out
+
+@contextmanager
+def atomic_write(path: str):
+    """先写入 path.tmp，完成后 os.replace 原子替换，中途中断不会留下半截文件"""
+    tmp = path + ".tmp"
+    try:
+        with open(tmp, "wb", buffering=1 << 20) as f:
+            yield f
+        os.replace(tmp, path)
+    except BaseException:
+        try:
+            os.remove(tmp)
+        except OSError:
+            pass
+        raise
+
+def write_json_array(f, items: list):
+    """逐条序列化写出 JSON 数组，不生成整份序列化副本；输出与 json_dumps(items) 完全一致"""
+    if not items:
+        f.write(b"[]")
+        return
+    f.write(b"[\n  ")
+    for i, it in enumerate(items):
+        if i:
+            f.write(b",\n  ")
+        # 字符串中的换行已被转义，这里只会替换缩进用的换行
+        f.write(json_dumps(it).replace(b"\n", b"\n  "))
+    f.write(b"\n]")
 
 def load_feeds() -> list[str]:
     """优先 data/feeds.json，其次根目录 feeds.json；支持 ['url', ...] 或 [{'url': '...'}]"""
     for path in ("data/feeds.json", "feeds.json"):
         if os.path.exists(path):
-            with open(path, "r", encoding="utf-8") as f:
-                data = json.load(f)
+            with open(path, "rb") as f:
+                data = json_loads(f.read())
             feeds = []
             if isinstance(data, list):
                 for it in data:
@@ -32,65 +114,195 @@ def load_feeds() -> list[str]:
                         feeds.append(it.strip())
                     elif isinstance(it, dict) and "url" in it:
                         feeds.append(str(it["url"]).strip())
-            return [u for u in feeds if u]
+            return dedup_feeds([u for u in feeds if u])
     print("⚠️ 未找到 feeds 列表（data/feeds.json 或 feeds.json）")
     return []
 
-def pick_date(entry):
-    """尽量从 entry 中取出 UTC 日期"""
+_ISO_DATE_RE = re.compile(r"(\d{4})-(\d{2})-(\d{2})")
+
+def pick_date(entry) -> tuple[int, str]:
+    """尽量从 entry 中取出 UTC 日期，返回 (时间戳, "YYYY-MM-DD")；取不到时返回 (0, "")"""
     for key in ("published_parsed", "updated_parsed", "created_parsed"):
-        if entry.get(key):
-            try:
-                return datetime(*entry[key][:6], tzinfo=timezone.utc)
-            except Exception:
-                pass
+        t = entry.get(key)
+        if t:
+            # *_parsed 已是 UTC struct_time，直接换算，不构造 datetime
+            return calendar.timegm(t), "%04d-%02d-%02d" % (t[0], t[1], t[2])
     for key in ("published", "updated", "created"):
         val = entry.get(key)
-        if isinstance(val, str) and len(val) >= 10:
-            try:
-                # 常见格式 YYYY-MM-DD...
-                return datetime.fromisoformat(val[:10] + "T00:00:00+00:00")
-            except Exception:
-                pass
-    return None
+        if isinstance(val, str):
+            # 常见格式 YYYY-MM-DD...
+            m = _ISO_DATE_RE.match(val)
+            if m:
+                y, mo, dd = int(m[1]), int(m[2]), int(m[3])
+                if y >= 1 and 1 <= mo <= 12 and 1 <= dd <= calendar.monthrange(y, mo)[1]:
+                    return calendar.timegm((y, mo, dd, 0, 0, 0)), m[0]
+    return 0, ""
 
-def date_to_str(d):
-    return d.astimezone(timezone.utc).strftime("%Y-%m-%d") if d else ""
+# 只匹配形似标签的文本，正文中的 "<"（如 "< $100"）保留
+_TAG_RE = re.compile(r"<[A-Za-z/!?][^>]*>")
+_WS_RE = re.compile(r"\s+")
 
 def clean_summary(txt: str) -> str:
     if not txt:
         return ""
-    t = txt.replace("\n", " ").replace("\r", " ")
-    for tag in ("<p>", "</p>", "<br>", "<br/>", "<br />"):
-        t = t.replace(tag, " ")
-    t = " ".join(t.split())
+    t = _TAG_RE.sub(" ", txt)
+    t = _WS_RE.sub(" ", t).strip()
     return (t[:140] + "…") if t else ""
 
+def _image_from_media_thumbnail(entry):
+    thumbs = entry.get("media_thumbnail")
+    return thumbs[0].get("url") if thumbs else None
+
+def _image_from_media_content(entry):
+    for m in entry.get("media_content") or ():
+        t = m.get("type") or ""
+        if (m.get("medium") == "image" or t[:6] == "image/") and m.get("url"):
+            return m["url"]
+    return None
+
+def _image_from_links(entry):
+    for l in entry.get("links") or ():
+        t = l.get("type") or ""
+        if t[:6] == "image/" and l.get("href"):
+            return l["href"]
+    return None
+
+def _image_from_itunes(entry):
+    img = entry.get("itunes_image")
+    return img.get("href") if img else None
+
+def _image_from_image(entry):
+    img = entry.get("image")
+    return img.get("href") if isinstance(img, dict) else None
+
+# 按优先级依次尝试，命中即返回
+_IMAGE_EXTRACTORS = (
+    _image_from_media_thumbnail,
+    _image_from_media_content,
+    _image_from_links,
+    _image_from_itunes,
+    _image_from_image,
+)
+
 def extract_image(entry) -> str | None:
     try:
-        if "media_thumbnail" in entry and entry.media_thumbnail:
-            url = entry.media_thumbnail[0].get("url")
-            if url: return url
-        if "media_content" in entry and entry.media_content:
-            for m in entry.media_content:
-                if m.get("medium") == "image" or str(m.get("type","")).startswith("image/"):
-                    if m.get("url"): return m["url"]
-        if "links" in entry and entry.links:
-            for l in entry.links:
-                if str(l.get("type","")).startswith("image/") and l.get("href"):
-                    return l["href"]
-        if "itunes_image" in entry and entry.itunes_image.get("href"):
-            return entry.itunes_image["href"]
-        if "image" in entry and isinstance(entry.image, dict) and entry.image.get("href"):
-            return entry.image["href"]
+        for fn in _IMAGE_EXTRACTORS:
+            url = fn(entry)
+            if url:
+                return url
     except Exception:
         pass
     return None
 
+def link_key(link: str) -> str:
+    """去重用的链接键：转小写并去掉 utm_* 追踪参数"""
+    k = link.lower()
+    if "utm_" not in k:
+        return k
+    try:
+        p = urlsplit(k)
+    except ValueError:  # 如 "http://[bad/..." 这类无法解析的链接，按原样去重
+        return k
+    query = "&".join(kv for kv in p.query.split("&") if kv and not kv.startswith("utm_"))
+    return urlunsplit((p.scheme, p.netloc, p.path, query, p.fragment))
+
+def title_key(title: str) -> str:
+    """去重用的标题键：转小写并合并空白"""
+    return " ".join(title.lower().split())
+
+def snapshot_feed(feed) -> dict:
+    """把解析结果压缩为可缓存的快照：校验头、正文摘要、最近更新时间（UTC 时间戳）与候选条目"""
+    entries = list(feed.entries or [])
+
+    # 每条只解析一次日期，供更新判断与条目输出复用
+    dated = [(e, *pick_date(e)) for e in entries]
+    latest = max((ts for _, ts, _ in dated), default=0)
+
+    # 限制每源条数
+    source = feed.feed.get("title", "RSS Source")
+    items = []
+    _append, _clean, _img = items.append, clean_summary, extract_image
+    for e, ts, day in dated[:PER_FEED_LIMIT]:
+        link = (e.get("link") or "").strip()
+        title = (e.get("title") or "").strip()
+        if not link or not title:
+            continue
+        _append({
+            "title": title,
+            "link": link,
+            "date": day,
+            "summary": _clean(e.get("summary", "")),
+            "source": source,
+            "image": _img(e),
+            "_sort_key": ts
+        })
+
+    return {
+        "etag": feed.get("etag"),
+        "modified": feed.get("modified"),
+        "digest": feed.get("digest"),
+        "latest": latest,
+        "items": items
+    }
+
+def load_cache() -> dict:
+    """读取上次运行的源缓存；不存在、损坏或版本不符时返回空缓存"""
+    try:
+        with open(CACHE_PATH, "rb") as f:
+            data = json_loads(f.read())
+    except Exception:
+        return {}
+    if not isinstance(data, dict) or data.get("version") != CACHE_VERSION:
+        return {}
+    feeds = data.get("feeds")
+    return feeds if isinstance(feeds, dict) else {}
+
+# 源未修改（304 或正文摘要与缓存一致）：只带回本次响应的校验头
+NotModified = namedtuple("NotModified", ["etag", "modified"])
+
+async def fetch_feed(session, sem, url, cached=None):
+    """条件请求下载单个源，解析放到线程中执行；304 或内容与缓存一致时返回 NotModified"""
+    req_headers = {}
+    if cached:
+        if cached.get("etag"):
+            req_headers["If-None-Match"] = cached["etag"]
+        if cached.get("modified"):
+            req_headers["If-Modified-Since"] = cached["modified"]
+    async with sem:
+        async with session.get(url, headers=req_headers) as resp:
+            headers = {k.lower(): v for k, v in resp.headers.items()}
+            if resp.status == 304 and cached:
+                # 304 可能不重复携带校验头，缺失时沿用缓存中的值
+                return NotModified(headers.get("etag") or cached.get("etag"),
+                                   headers.get("last-modified") or cached.get("modified"))
+            # 4xx/5xx 错误页不能当作源内容，否则会覆盖缓存中的正常快照
+            resp.raise_for_status()
+            body = await resp.read()
+            headers.setdefault("content-location", str(resp.url))
+    # 不支持条件请求的源：正文摘要未变也跳过解析；校验头以本次 200 响应为准
+    digest = hashlib.blake2b(body, digest_size=16).hexdigest()
+    if cached and cached.get("digest") == digest:
+        return NotModified(headers.get("etag"), headers.get("last-modified"))
+    feed = await asyncio.to_thread(feedparser.parse, body, response_headers=headers)
+    feed["etag"] = headers.get("etag")
+    feed["modified"] = headers.get("last-modified")
+    feed["digest"] = digest
+    return feed
+
+async def fetch_all(urls, cache):
+    """并发抓取所有源，返回 [(url, feed / NotModified / 异常), ...]，顺序与 urls 一致"""
+    sem = asyncio.Semaphore(FETCH_CONCURRENCY)
+    timeout = aiohttp.ClientTimeout(total=FETCH_TIMEOUT)
+    async with aiohttp.ClientSession(timeout=timeout, headers={"User-Agent": USER_AGENT}) as session:
+        results = await asyncio.gather(*(fetch_feed(session, sem, u, cache.get(u)) for u in urls), return_exceptions=True)
+    return list(zip(urls, results))
+
 def main():
     feeds = load_feeds()
     now_utc = datetime.now(timezone.utc)
     stale_cutoff = now_utc - timedelta(days=STALE_DAYS)
+    # 每次运行只算一次，之后各源都做整数比较
+    stale_ts = int(stale_cutoff.timestamp())
 
     stats = {
         "total_sources": len(feeds),
@@ -101,69 +313,74 @@ def main():
     }
 
     all_items = []
+    # 精确去重：规模上限为 源数 × PER_FEED_LIMIT，普通 set 足够；
+    # 不用 Bloom filter，避免误判把真实新闻当作重复丢掉
     seen_links = set()
+    # 同一文章在不同源/不同追踪参数下链接不同，再按标题去重一次
+    seen_titles = set()
 
-    for url in feeds:
-        try:
-            feed = feedparser.parse(url)
-            entries = list(feed.entries or [])
-            if not entries:
-                # 空源：按无更新处理
-                stats["skipped_stale"] += 1
-                continue
+    cache = load_cache()
+    results = asyncio.run(fetch_all(feeds, cache))
+
+    # 热循环中用局部绑定代替属性查找
+    _seen_in, _seen_add, _append = seen_links.__contains__, seen_links.add, all_items.append
+    _title_in, _title_add = seen_titles.__contains__, seen_titles.add
 
-            # 判断该源最近是否有更新
-            latest_dt = None
-            for e in entries:
-                d = pick_date(e)
-                if d and (latest_dt is None or d > latest_dt):
-                    latest_dt = d
+    for url, feed in results:
+        try:
+            if isinstance(feed, BaseException):
+                raise feed
+            if isinstance(feed, NotModified):
+                # 未修改：沿用上次的快照，校验头更新为本次响应的值
+                snap = cache[url]
+                snap["etag"], snap["modified"] = feed.etag, feed.modified
+                if any("_sort_key" not in it for it in snap["items"]):
+                    # 快照不完整（如被手工改过）：丢弃，下次重新完整抓取
+                    del cache[url]
+                    raise ValueError("缓存快照条目缺少 _sort_key")
+            else:
+                snap = cache[url] = snapshot_feed(feed)
 
-            if (latest_dt is None) or (latest_dt < stale_cutoff):
-                # 超过 STALE_DAYS 无更新：跳过
+            if not snap["latest"] or snap["latest"] < stale_ts:
+                # 空源或超过 STALE_DAYS 无更新：跳过
                 stats["skipped_stale"] += 1
                 continue
 
-            # 限制每源条数
-            entries = entries[:PER_FEED_LIMIT]
-            source = feed.feed.get("title", "RSS Source")
-
-            for e in entries:
-                link = (e.get("link") or "").strip()
-                title = (e.get("title") or "").strip()
-                if not link or not title:
-                    continue
-                if link.lower() in seen_links:
+            for item in snap["items"]:
+                lk = link_key(item["link"])
+                tk = title_key(item["title"])
+                if _seen_in(lk) or _title_in(tk):
                     continue
-
-                item = {
-                    "title": title,
-                    "link": link,
-                    "date": date_to_str(pick_date(e)),
-                    "summary": clean_summary(e.get("summary", "")),
-                    "source": source,
-                    "image": extract_image(e)
-                }
-                all_items.append(item)
-                seen_links.add(link.lower())
+                _append(item)
+                _seen_add(lk)
+                _title_add(tk)
 
             stats["used_sources"] += 1
 
         except Exception as ex:
             stats["errors"] += 1
-            print(f"❌ 解析失败：{url} -> {ex}")
+            print(f"❌ 解析失败：{url} -> {type(ex).__name__}: {ex}")
 
     stats["items_before_dedup"] = len(all_items)
 
     # 全局排序与总量裁剪
-    all_items.sort(key=lambda x: x.get("date",""), reverse=True)
+    # 超出上限时只取前 TOTAL_LIMIT 条（与排序后切片结果一致）
     if TOTAL_LIMIT and len(all_items) > TOTAL_LIMIT:
-        all_items = all_items[:TOTAL_LIMIT]
+        all_items = heapq.nlargest(TOTAL_LIMIT, all_items, key=itemgetter("_sort_key"))
+    else:
+        all_items.sort(key=itemgetter("_sort_key"), reverse=True)
 
     os.makedirs("data", exist_ok=True)
 
-    with open("data/news.json", "w", encoding="utf-8") as f:
-        json.dump(all_items, f, ensure_ascii=False, indent=2)
+    # 只保留当前源列表的缓存，供下次条件请求使用（条目保留 _sort_key）
+    cache = {u: cache[u] for u in feeds if u in cache}
+    with atomic_write(CACHE_PATH) as f:
+        f.write(json_dumps({"version": CACHE_VERSION, "feeds": cache}))
+
+    for it in all_items:
+        it.pop("_sort_key", None)
+    with atomic_write("data/news.json") as f:
+        write_json_array(f, all_items)
 
     meta = {
         "updated": now_utc.strftime("%Y-%m-%d %H:%M UTC"),
@@ -175,11 +392,11 @@ def main():
             "total_limit": TOTAL_LIMIT
         }
     }
-    with open("data/meta.json", "w", encoding="utf-8") as f:
-        json.dump(meta, f, ensure_ascii=False, indent=2)
+    with atomic_write("data/meta.json") as f:
+        f.write(json_dumps(meta))
 
     print("✅ 聚合完成")
-    print(json.dumps(meta, ensure_ascii=False, indent=2))
+    print(json_dumps(meta).decode("utf-8"))
 
 if __name__ == "__main__":
     main()